@@ -1,14 +1,41 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
-from collections import defaultdict
-import copy
+from collections import Counter, defaultdict, namedtuple, OrderedDict
+from dataclasses import dataclass
+import hashlib
+import heapq
+import json
+import logging
 import math
+import operator
+import os
 import random
-import itertools
+import threading
+
+try:
+    import orjson  # optional: faster serialization of large timetables
+except ImportError:
+    orjson = None
 
 
 app = Flask(__name__)
 CORS(app)
+# per-request progress is logged at DEBUG; set TIMETABLE_LOG_LEVEL=DEBUG to see it.
+# An unknown level name falls back to INFO instead of failing at import.
+_log_level = logging.getLevelName(os.environ.get("TIMETABLE_LOG_LEVEL", "INFO").upper())
+app.logger.setLevel(_log_level if isinstance(_log_level, int) else logging.INFO)
+
+
+# placeholder subjects and the lunch slot name; use these rather than the literals
+FREE = "FREE"
+LUNCH = "LUNCH"
+LUNCH_BREAK = "Lunch Break"
+WORKSHOP = "Workshop"
+_SKIP = frozenset((FREE, LUNCH))  # cell markers that are not lectures
+
+# one timetable cell entry; `group` is the lab group label, None for theory
+# and placeholders, so every entry has the same layout
+Entry = namedtuple("Entry", "subject room teacher group", defaults=(None,))
 
 
 # ----------------- Data Structure Transformation -----------------
@@ -18,8 +45,9 @@ def transform_classes_to_sections(data):
     Transform the new classes-based data structure to the old sections-based structure
     that the existing algorithms expect.
     """
-    # Create a copy of the original data
-    transformed_data = copy.deepcopy(data)
+    # Shallow copy: downstream code only reads rooms/teachers/slots etc.,
+    # so only the per-section lists built below need their own storage
+    transformed_data = {k: v for k, v in data.items() if k != 'classes'}
     
     # Extract sections from classes
     sections = []
@@ -42,8 +70,8 @@ def transform_classes_to_sections(data):
             section_data = {
                 'name': full_section_name,
                 'student_count': section_info.get('student_count', 0),
-                'subjects': class_subjects.copy(),
-                'lab_subjects': class_lab_subjects.copy(),
+                'subjects': list(class_subjects),
+                'lab_subjects': list(class_lab_subjects),
                 'class_name': class_name,  # Keep reference to parent class
                 'section_name': section_name
             }
@@ -53,10 +81,6 @@ def transform_classes_to_sections(data):
     # Replace classes with sections in the transformed data
     transformed_data['sections'] = sections
     
-    # Remove the classes key as it's no longer needed
-    if 'classes' in transformed_data:
-        del transformed_data['classes']
-    
     return transformed_data
 
 def validate_input_data(data):
@@ -119,7 +143,7 @@ def validate_input_data(data):
         errors.append('At least one day must be defined')
     
     if 'slots' in data:
-        non_lunch_slots = [s for s in data.get('slots', []) if s != 'Lunch Break']
+        non_lunch_slots = [s for s in data.get('slots', []) if s != LUNCH_BREAK]
         if len(non_lunch_slots) < 1:
             errors.append('At least one time slot must be defined')
     
@@ -131,19 +155,14 @@ def validate_input_data(data):
     
     teachers = data.get('teachers', {})
     lab_teachers = data.get('lab_teachers', {})
+    unassigned = all_subjects - teachers.keys() - lab_teachers.keys()
     
     for subject in all_subjects:
-        if subject not in teachers and subject not in lab_teachers:
+        if subject in unassigned:
             warnings.append(f'No teacher assigned to subject: {subject}')
-        else:
-            assigned_teachers = []
-            if subject in teachers:
-                assigned_teachers.extend([t for t in teachers[subject] if t.strip()])
-            if subject in lab_teachers:
-                assigned_teachers.extend([t for t in lab_teachers[subject] if t.strip()])
-            
-            if not assigned_teachers:
-                warnings.append(f'Subject "{subject}" has no valid teachers assigned')
+        elif not (any(t.strip() for t in teachers.get(subject, ()))
+                  or any(t.strip() for t in lab_teachers.get(subject, ()))):
+            warnings.append(f'Subject "{subject}" has no valid teachers assigned')
     
     # Check lab room assignments
     lab_rooms = data.get('lab_rooms', {})
@@ -175,7 +194,9 @@ def assign_fixed_classrooms(data):
 
 
 def create_fixed_teacher_mapping(data):
+    # round-robin per subject so identical input always yields the same mapping
     mapping = {}
+    per_sub_counter = defaultdict(int)
     for sec in data["sections"]:
         secname = sec["name"]
         subjects = sec.get("subjects", []) + sec.get("lab_subjects", [])
@@ -192,12 +213,28 @@ def create_fixed_teacher_mapping(data):
                     teachers = [None]
             if not teachers:
                 teachers = [None]
-            idx = abs(hash((secname, sub))) % len(teachers)
+            idx = per_sub_counter[sub] % len(teachers)
+            per_sub_counter[sub] += 1
             mapping[(secname, sub)] = teachers[idx]
     return mapping
 
 
 
+def fixed_teacher_rows(data, fixed_teachers):
+    """
+    Per-section view of `fixed_teachers` indexed like data["sections"]:
+    rows[si][subject] -> teacher, so the solver loops look a teacher up by
+    section position instead of building a (section, subject) key each time.
+    """
+    rows = []
+    for sec in data["sections"]:
+        secname = sec["name"]
+        subjects = sec.get("subjects", []) + sec.get("lab_subjects", [])
+        rows.append({sub: fixed_teachers.get((secname, sub)) for sub in subjects})
+    return rows
+
+
+
 def get_lab_groups_map(data):
     cap = data.get("lab_capacity", 30)
     groups = {}
@@ -216,19 +253,85 @@ def make_group_labels(num_groups):
 def make_empty_timetable(data):
     timetable = {}
     for sec in data["sections"]:
-        name = sec["name"]
-        timetable[name] = {}
+        schedule = timetable[sec["name"]] = {}
         for day in data["days"]:
-            timetable[name][day] = {}
+            day_schedule = schedule[day] = {}
             for slot in data["slots"]:
-                if slot == "Lunch Break":
-                    timetable[name][day][slot] = [("LUNCH", None, None)]
+                if slot == LUNCH_BREAK:
+                    day_schedule[slot] = [Entry(LUNCH, None, None)]
                 else:
-                    timetable[name][day][slot] = []
+                    day_schedule[slot] = []
     return timetable
 
 
 
+def build_occupancy_masks(data, timetable):
+    """
+    Flat list of slot-occupancy bitmasks, one per (section, day), stored at
+    section_pos * len(days) + day_pos (positions in data["sections"] /
+    data["days"]). Bit i is set when data["slots"][i] holds any non-FREE
+    entry (LUNCH included).
+    """
+    masks = []
+    for sec in data["sections"]:
+        schedule = timetable[sec["name"]]
+        for day in data["days"]:
+            day_schedule = schedule[day]
+            mask = 0
+            for i, slot in enumerate(data["slots"]):
+                if any(entry and entry[0] != FREE for entry in day_schedule[slot]):
+                    mask |= 1 << i
+            masks.append(mask)
+    return masks
+
+
+
+@dataclass
+class SolveContext:
+    """Slot/day lookups and availability that stay fixed for a whole solve."""
+    days: tuple
+    slots_all: tuple
+    slots_no_lunch: tuple
+    slot_bit: dict      # slot -> bit position in slots_all
+    slot_index: dict    # slot -> position in slots_no_lunch
+    day_pos: dict
+    day_shift: dict     # day -> offset of its first slot in a week-wide bitmask
+    unavail_set: set
+    unavail_masks: dict  # teacher -> week-wide bitmask of unavailable cells
+    slot_pairs: list
+    pair_masks: dict
+    teacher_rows: list = None  # fixed_teacher_rows(); None when built without fixed_teachers
+
+
+
+def build_solve_context(data, fixed_teachers=None):
+    slots_all = tuple(data["slots"])
+    slots_no_lunch = tuple(s for s in slots_all if s != LUNCH_BREAK)
+    slot_bit = {s: i for i, s in enumerate(slots_all)}
+    slot_pairs = slot_pairs_order(data)
+    day_shift = {d: i * len(slots_all) for i, d in enumerate(data["days"])}
+    unavail_set = build_unavail_set(data)
+    unavail_masks = defaultdict(int)
+    for t, d, s in unavail_set:
+        if t and d in day_shift and s in slot_bit:
+            unavail_masks[t] |= 1 << (day_shift[d] + slot_bit[s])
+    return SolveContext(
+        days=tuple(data["days"]),
+        slots_all=slots_all,
+        slots_no_lunch=slots_no_lunch,
+        slot_bit=slot_bit,
+        slot_index={s: i for i, s in enumerate(slots_no_lunch)},
+        day_pos={d: i for i, d in enumerate(data["days"])},
+        day_shift=day_shift,
+        unavail_set=unavail_set,
+        unavail_masks=dict(unavail_masks),
+        slot_pairs=slot_pairs,
+        pair_masks={pair: (1 << slot_bit[pair[0]]) | (1 << slot_bit[pair[1]]) for pair in slot_pairs},
+        teacher_rows=fixed_teacher_rows(data, fixed_teachers) if fixed_teachers is not None else None,
+    )
+
+
+
 # ----------------- Scheduler Core -----------------
 
 
@@ -244,7 +347,7 @@ def slot_pairs_order(data):
 
 
     for i in range(len(slots) - 1):
-        if slots[i] == "Lunch Break" or slots[i + 1] == "Lunch Break":
+        if slots[i] == LUNCH_BREAK or slots[i + 1] == LUNCH_BREAK:
             continue
         pairs.append((i, i + 1))
 
@@ -263,6 +366,16 @@ def slot_pairs_order(data):
 
 
 
+def build_unavail_set(data):
+    """Flatten teacher_unavailability into a set of (teacher, day, slot) for O(1) lookups."""
+    return {
+        (t, u.get("day"), u.get("slot"))
+        for t, lst in data.get("teacher_unavailability", {}).items()
+        for u in lst
+    }
+
+
+
 def teacher_unavailable_on(teacher, day, slot, data):
     if not teacher:
         return False
@@ -276,218 +389,271 @@ def teacher_unavailable_on(teacher, day, slot, data):
 
 
 
-def can_place_block(timetable, secname, day, pair, room, teacher, used_rooms, used_teachers, data):
-    for slot in pair:
-        existing = timetable[secname][day][slot]
-        if any(entry and entry[0] not in ("FREE",) for entry in existing):
-            return False
-        if room and (room, day, slot) in used_rooms:
-            return False
-        if teacher and (teacher, day, slot) in used_teachers:
-            return False
-        if teacher_unavailable_on(teacher, day, slot, data):
-            return False
-    return True
+# soft-constraint costs when a lab block can only go where its teacher is
+# already teaching or marked unavailable
+LAB_TEACHER_CONFLICT_COST = 100
+LAB_TEACHER_UNAVAILABLE_COST = 50
 
 
+# parallel per-task columns for assign_all_labs, indexed by task id
+LabTasks = namedtuple("LabTasks", "section sec_row lab group_index group_label room teacher assigned")
 
-def assign_all_labs(data, timetable, fixed_teachers, fixed_classrooms):
-    slot_pairs = slot_pairs_order(data)
-    days = data["days"]
+
+
+def iter_lab_combos(groups, k, task_labs):
+    """
+    Yield k-tuples of task ids taken from distinct groups with distinct labs.
+    `groups` holds the pending task ids bucketed per group in group order; combos
+    come out in the same order itertools.combinations(pending, k) would visit
+    the valid ones, but invalid branches are pruned instead of generated.
+    """
+    chosen = []
+    labs = set()
+
+    def walk(start):
+        if len(chosen) == k:
+            yield tuple(chosen)
+            return
+        for gpos in range(start, len(groups) - (k - len(chosen)) + 1):
+            for t in groups[gpos]:
+                lab = task_labs[t]
+                if lab in labs:
+                    continue
+                chosen.append(t)
+                labs.add(lab)
+                yield from walk(gpos + 1)
+                chosen.pop()
+                labs.discard(lab)
+
+    return walk(0)
+
+
+
+def assign_all_labs(data, timetable, fixed_teachers, fixed_classrooms, ctx=None):
+    if ctx is None:
+        ctx = build_solve_context(data, fixed_teachers)
+    slot_pairs = ctx.slot_pairs
+    days = ctx.days
     lab_rooms_map = data.get("lab_rooms", {})
     lab_groups_map = get_lab_groups_map(data)
+    unavail_masks = ctx.unavail_masks
+    day_shift = ctx.day_shift
+    occ_mask = build_occupancy_masks(data, timetable)
+    pair_masks = ctx.pair_masks
+    teacher_rows = ctx.teacher_rows
 
 
-    tasks = []
-    for sec in data["sections"]:
+    num_days = len(days)
+    tasks = LabTasks([], [], [], [], [], [], [], bytearray())
+    pending_by_sec = defaultdict(list)
+    for si, sec in enumerate(data["sections"]):
         secname = sec["name"]
         num_groups = lab_groups_map[secname]
         group_labels = make_group_labels(num_groups)
+        sec_teachers = teacher_rows[si]
         # each group for each lab subject needs a session
         for gi, gl in enumerate(group_labels):
             for lab in sec.get("lab_subjects", []):
-                tasks.append({
-                    "section": secname,
-                    "lab": lab,
-                    "group_index": gi,
-                    "group_label": gl,
-                    "assigned": False
-                })
-
-
-    used_rooms = set()
-    used_teachers = set()
+                # room and teacher depend only on the task, resolve them once
+                available_rooms = lab_rooms_map.get(lab) or data.get("labs") or [fixed_classrooms.get(secname)]
+                pending_by_sec[secname].append(len(tasks.assigned))
+                tasks.section.append(secname)
+                tasks.sec_row.append(si * num_days)
+                tasks.lab.append(lab)
+                tasks.group_index.append(gi)
+                tasks.group_label.append(gl)
+                tasks.room.append(available_rooms[gi % len(available_rooms)])
+                tasks.teacher.append(sec_teachers[lab])
+                tasks.assigned.append(0)
+    task_lab = tasks.lab
+    task_room = tasks.room
+    task_teacher = tasks.teacher
+    task_label = tasks.group_label
+    assigned = tasks.assigned
+    unassigned = len(assigned)
+
+
+    # resource name -> week-wide bitmask of occupied (day, slot) cells
+    room_busy = {}
+    teacher_busy = {}
+
+
+    def has_conflict(room, teacher, cells, temp_rooms, temp_teachers):
+        if room and (room_busy.get(room, 0) | temp_rooms.get(room, 0)) & cells:
+            return True
+        if teacher and (teacher_busy.get(teacher, 0) | temp_teachers.get(teacher, 0)
+                        | unavail_masks.get(teacher, 0)) & cells:
+            return True
+        return False
 
 
     # primary pass: try combos per section/day/pair
     for pair in slot_pairs:
-        if all(t["assigned"] for t in tasks):
+        if not unassigned:
             break
-        for day in days:
-            if all(t["assigned"] for t in tasks):
+        pair_mask = pair_masks[pair]
+        for di, day in enumerate(days):
+            if not unassigned:
                 break
-            for sec in data["sections"]:
+            for si, sec in enumerate(data["sections"]):
                 secname = sec["name"]
-                pending = [t for t in tasks if (not t["assigned"]) and t["section"] == secname]
+                pending = pending_by_sec[secname]
                 if not pending:
                     continue
-                parallel_cap = min(lab_groups_map[secname], 3)
+                cell = si * num_days + di
+                if occ_mask[cell] & pair_mask:
+                    continue
+                cells = pair_mask << day_shift[day]
+                by_group = defaultdict(list)
+                for t in pending:
+                    by_group[tasks.group_index[t]].append(t)
+                groups = [by_group[gi] for gi in sorted(by_group)]
+                parallel_cap = min(lab_groups_map[secname], 3, len(groups))
                 assigned_in_this_pair = False
                 for k in range(parallel_cap, 0, -1):
-                    for combo in itertools.combinations(pending, k):
-                        group_idxs = {c["group_index"] for c in combo}
-                        labs_set = {c["lab"] for c in combo}
-                        if len(group_idxs) != k or len(labs_set) != k:
-                            continue
+                    for combo in iter_lab_combos(groups, k, task_lab):
                         ok = True
-                        temp_rooms = set()
-                        temp_teachers = set()
+                        temp_rooms = {}
+                        temp_teachers = {}
                         for c in combo:
-                            gi = c["group_index"]
-                            lab = c["lab"]
-                            available_rooms = lab_rooms_map.get(lab, [])
-                            if not available_rooms:
-                                available_rooms = data.get("labs", []) or [fixed_classrooms.get(secname)]
-                            room = available_rooms[gi % len(available_rooms)] if available_rooms else None
-                            teacher = fixed_teachers.get((secname, lab))
-                            for slot in pair:
-                                if any(entry and entry[0] not in ("FREE",) for entry in timetable[secname][day][slot]):
-                                    ok = False
-                                    break
-                                if room and (room, day, slot) in used_rooms:
-                                    ok = False
-                                    break
-                                if teacher and (teacher, day, slot) in used_teachers:
-                                    ok = False
-                                    break
-                                if room and (room, day, slot) in temp_rooms:
-                                    ok = False
-                                    break
-                                if teacher and (teacher, day, slot) in temp_teachers:
-                                    ok = False
-                                    break
-                                if teacher_unavailable_on(teacher, day, slot, data):
-                                    ok = False
-                                    break
-                            if not ok:
+                            room = task_room[c]
+                            teacher = task_teacher[c]
+                            if has_conflict(room, teacher, cells, temp_rooms, temp_teachers):
+                                ok = False
                                 break
-                            for slot in pair:
-                                if room:
-                                    temp_rooms.add((room, day, slot))
-                                if teacher:
-                                    temp_teachers.add((teacher, day, slot))
+                            if room:
+                                temp_rooms[room] = temp_rooms.get(room, 0) | cells
+                            if teacher:
+                                temp_teachers[teacher] = temp_teachers.get(teacher, 0) | cells
                         if not ok:
                             continue
                         # commit combo
                         for c in combo:
-                            gi = c["group_index"]
-                            lab = c["lab"]
-                            available_rooms = lab_rooms_map.get(lab, [])
-                            if not available_rooms:
-                                available_rooms = data.get("labs", []) or [fixed_classrooms.get(secname)]
-                            room = available_rooms[gi % len(available_rooms)] if available_rooms else None
-                            teacher = fixed_teachers.get((secname, lab))
-                            label = c["group_label"]
+                            lab = task_lab[c]
+                            room = task_room[c]
+                            teacher = task_teacher[c]
+                            label = task_label[c]
                             for slot in pair:
-                                timetable[secname][day][slot].append((lab, room, teacher, label))
-                                if room:
-                                    used_rooms.add((room, day, slot))
-                                if teacher:
-                                    used_teachers.add((teacher, day, slot))
-                            c["assigned"] = True
+                                timetable[secname][day][slot].append(Entry(lab, room, teacher, label))
+                            if room:
+                                room_busy[room] = room_busy.get(room, 0) | cells
+                            if teacher:
+                                teacher_busy[teacher] = teacher_busy.get(teacher, 0) | cells
+                            assigned[c] = 1
+                        occ_mask[cell] |= pair_mask
+                        pending_by_sec[secname] = [t for t in pending if not assigned[t]]
+                        unassigned -= len(combo)
                         assigned_in_this_pair = True
                         break
                     if assigned_in_this_pair:
                         break
 
 
-    # secondary pass: one-by-one
-    for tsk in tasks:
-        if tsk["assigned"]:
+    # secondary pass: one-by-one, scoring every open block. Section
+    # occupancy and room clashes are hard; teacher clashes and unavailability
+    # only cost, and a block with any cost is taken without its teacher.
+    for i in range(len(assigned)):
+        if assigned[i]:
             continue
-        secname = tsk["section"]
-        lab = tsk["lab"]
-        gi = tsk["group_index"]
-        available_rooms = lab_rooms_map.get(lab, [])
-        if not available_rooms:
-            available_rooms = data.get("labs", []) or [fixed_classrooms.get(secname)]
-        room = available_rooms[gi % len(available_rooms)] if available_rooms else None
-        teacher = fixed_teachers.get((secname, lab))
-        placed = False
+        secname = tasks.section[i]
+        lab = task_lab[i]
+        room = task_room[i]
+        teacher = task_teacher[i]
+        label = task_label[i]
+        sec_row = tasks.sec_row[i]
+        room_mask = room_busy.get(room, 0) if room else 0
+        busy_mask = teacher_busy.get(teacher, 0) if teacher else 0
+        away_mask = unavail_masks.get(teacher, 0) if teacher else 0
+        best = None
+        best_cost = math.inf
         for pair in slot_pairs:
-            for day in days:
-                if can_place_block(timetable, secname, day, pair, room, teacher, used_rooms, used_teachers, data):
-                    label = tsk["group_label"]
-                    for slot in pair:
-                        timetable[secname][day][slot].append((lab, room, teacher, label))
-                        if room:
-                            used_rooms.add((room, day, slot))
-                        if teacher:
-                            used_teachers.add((teacher, day, slot))
-                    tsk["assigned"] = True
-                    placed = True
-                    break
-            if placed:
-                break
-        if not tsk["assigned"]:
-            # last resort: ignore teacher conflicts
-            for pair in slot_pairs:
-                for day in days:
-                    ok = True
-                    for slot in pair:
-                        if any(entry and entry[0] not in ("FREE",) for entry in timetable[secname][day][slot]):
-                            ok = False
-                            break
-                        if room and (room, day, slot) in used_rooms:
-                            ok = False
-                            break
-                    if ok:
-                        label = tsk["group_label"]
-                        for slot in pair:
-                            timetable[secname][day][slot].append((lab, room, None, label))
-                            if room:
-                                used_rooms.add((room, day, slot))
-                        tsk["assigned"] = True
-                        ok = True
+            pair_mask = pair_masks[pair]
+            for di, day in enumerate(days):
+                if occ_mask[sec_row + di] & pair_mask:
+                    continue
+                cells = pair_mask << day_shift[day]
+                if room_mask & cells:
+                    continue
+                cost = 0
+                if busy_mask & cells:
+                    cost += LAB_TEACHER_CONFLICT_COST
+                if away_mask & cells:
+                    cost += LAB_TEACHER_UNAVAILABLE_COST
+                if cost < best_cost:
+                    best = (pair, di, day, cells)
+                    best_cost = cost
+                    if not cost:
                         break
-                if tsk["assigned"]:
-                    break
-        if not tsk["assigned"]:
+            if best is not None and not best_cost:
+                break
+        if best is not None:
+            pair, di, day, cells = best
+            if best_cost:
+                teacher = None
+            for slot in pair:
+                timetable[secname][day][slot].append(Entry(lab, room, teacher, label))
+            if room:
+                room_busy[room] = room_mask | cells
+            if teacher:
+                teacher_busy[teacher] = busy_mask | cells
+            occ_mask[sec_row + di] |= pair_masks[pair]
+            assigned[i] = 1
+        if not assigned[i]:
             last_day = days[0]
-            last_slot = data["slots"][-1]
-            timetable[secname][last_day][last_slot].append((f"{lab}-UNSCHED", None, None, tsk["group_label"]))
-            tsk["assigned"] = True
+            last_slot = ctx.slots_all[-1]
+            timetable[secname][last_day][last_slot].append(Entry(f"{lab}-UNSCHED", None, None, label))
+            assigned[i] = 1
 
 
-    return timetable
+    return timetable, room_busy, teacher_busy
 
 
 
-def assign_theory_subjects(data, timetable, fixed_teachers, fixed_classrooms):
-    days = data["days"]
-    slots = [s for s in data["slots"] if s != "Lunch Break"]
-    slot_index = {s: i for i, s in enumerate(slots)}
+def assign_theory_subjects(data, timetable, fixed_teachers, fixed_classrooms, ctx=None, room_busy=None, teacher_busy=None):
+    """
+    Returns (timetable, unfulfilled, written_masks). `written_masks` uses the
+    build_occupancy_masks layout and marks the cells this pass filled with a
+    lecture or FREE: exactly the cells that were empty when it started, since
+    theory never shares a cell with a lab and every empty cell ends up FREE.
+    """
+    if ctx is None:
+        ctx = build_solve_context(data, fixed_teachers)
+    days = ctx.days
+    slots = ctx.slots_no_lunch
+    slot_index = ctx.slot_index
     constraints = data.get("constraints", {})
     max_subj_per_day = constraints.get("max_lectures_per_subject_per_day", 2)
     max_daily = constraints.get("max_lectures_per_day_section", 6)
     lecture_req = data.get("lecture_requirements", {})
-
-
-    used_rooms = set()
-    used_teachers = set()
-    for sec in timetable:
-        for day in days:
-            for slot in data["slots"]:
-                for entry in timetable[sec][day][slot]:
-                    if entry[0] in ("FREE", "LUNCH", "Workshop"):
-                        continue
-                    subj = entry[0]
-                    room = entry[1]
-                    teacher = entry[2]
-                    if room:
-                        used_rooms.add((room, day, slot))
-                    if teacher:
-                        used_teachers.add((teacher, day, slot))
+    unavail_masks = ctx.unavail_masks
+    occ_mask = build_occupancy_masks(data, timetable)
+    all_bits = (1 << len(ctx.slots_all)) - 1
+    written_masks = [~m & all_bits for m in occ_mask]
+    slot_bit = ctx.slot_bit
+    day_pos = ctx.day_pos
+    day_shift = ctx.day_shift
+    teacher_rows = ctx.teacher_rows
+
+
+    # the lab pass hands over its resource masks; rebuild them only when the
+    # timetable was edited in between (e.g. the relaxed retry)
+    if room_busy is None or teacher_busy is None:
+        room_busy = {}
+        teacher_busy = {}
+        for schedule in timetable.values():
+            for day in days:
+                day_schedule = schedule[day]
+                for slot in ctx.slots_all:
+                    bit = 1 << (day_shift[day] + slot_bit[slot])
+                    for entry in day_schedule[slot]:
+                        if entry[0] in (FREE, LUNCH, WORKSHOP):
+                            continue
+                        room = entry[1]
+                        teacher = entry[2]
+                        if room:
+                            room_busy[room] = room_busy.get(room, 0) | bit
+                        if teacher:
+                            teacher_busy[teacher] = teacher_busy.get(teacher, 0) | bit
 
 
     remaining = {}
@@ -502,46 +668,83 @@ def assign_theory_subjects(data, timetable, fixed_teachers, fixed_classrooms):
     daily_total = {sec["name"]: {d: 0 for d in days} for sec in data["sections"]}
 
 
-    for sec in data["sections"]:
+    for si, sec in enumerate(data["sections"]):
         secname = sec["name"]
+        sec_row = si * len(days)
+        schedule = timetable[secname]
         subjects = sec.get("subjects", [])
-        subjects.sort(key=lambda s: -remaining[secname].get(s, 0))
+        fixed_room = fixed_classrooms.get(secname)
+        sec_teachers = teacher_rows[si]
+        # most constrained first: fewest open cells for the subject's teacher,
+        # then most lectures still required
+        open_cells = {}
+        room_block = room_busy.get(fixed_room, 0) if fixed_room else 0
+        for sub in subjects:
+            teacher = sec_teachers[sub]
+            blocked = room_block
+            if teacher:
+                blocked |= teacher_busy.get(teacher, 0) | unavail_masks.get(teacher, 0)
+            count = 0
+            for di, day in enumerate(days):
+                mask = occ_mask[sec_row + di]
+                shift = day_shift[day]
+                for slot in slots:
+                    if mask & (1 << slot_bit[slot]):
+                        continue
+                    if blocked & (1 << (shift + slot_bit[slot])):
+                        continue
+                    count += 1
+            open_cells[sub] = count
+        subjects.sort(key=lambda s: (open_cells[s], -remaining[secname].get(s, 0)))
+        # least-loaded day first; ties keep the input day order
+        day_heap = [(daily_total[secname][d], day_pos[d], d) for d in days]
+        heapq.heapify(day_heap)
         for sub in subjects:
             req = remaining[secname][sub]
             if req <= 0:
                 continue
-            teacher = fixed_teachers.get((secname, sub))
-            fixed_room = fixed_classrooms.get(secname)
-            attempts = 0
-            while req > 0 and attempts < len(days) * len(slots) * 3:
-                candidate_days = sorted(days, key=lambda d: daily_total[secname][d])
+            teacher = sec_teachers[sub]
+            # each pass either places one lecture, or makes one swap and retries,
+            # or ends the subject: no fixed retry budget
+            swapped = False
+            while req > 0:
                 placed = False
-                for day in candidate_days:
+                popped = []
+                while day_heap:
+                    popped.append(heapq.heappop(day_heap))
+                    day = popped[-1][2]
                     if daily_subj_count[secname][day][sub] >= max_subj_per_day:
                         continue
                     if daily_total[secname][day] >= max_daily:
                         continue
+                    cell = sec_row + day_pos[day]
+                    shift = day_shift[day]
+                    day_schedule = schedule[day]
+                    blocked = room_busy.get(fixed_room, 0) if fixed_room else 0
+                    if teacher:
+                        blocked |= teacher_busy.get(teacher, 0) | unavail_masks.get(teacher, 0)
                     for slot in slots:
-                        if any(e and e[0] not in ("FREE",) and (len(e) > 3) for e in timetable[secname][day][slot]):
-                            continue
-                        if any(e and e[0] not in ("FREE",) and (len(e) <= 3 and e[0] != sub) for e in timetable[secname][day][slot]):
-                            continue
-                        if teacher and teacher_unavailable_on(teacher, day, slot, data):
+                        bit = 1 << slot_bit[slot]
+                        if occ_mask[cell] & bit:
+                            if any(e and e[0] != FREE and e.group is not None for e in day_schedule[slot]):
+                                continue
+                            if any(e and e[0] != FREE and (e.group is None and e[0] != sub) for e in day_schedule[slot]):
+                                continue
+                        week_bit = 1 << (shift + slot_bit[slot])
+                        if blocked & week_bit:
                             continue
                         prev_idx = slot_index[slot] - 1
                         if prev_idx >= 0:
                             prev_slot = slots[prev_idx]
-                            prev_entries = timetable[secname][day][prev_slot]
+                            prev_entries = day_schedule[prev_slot]
                             if any(e[0] == sub for e in prev_entries):
                                 continue
-                        if fixed_room and (fixed_room, day, slot) in used_rooms:
-                            continue
-                        if teacher and (teacher, day, slot) in used_teachers:
-                            continue
-                        timetable[secname][day][slot].append((sub, fixed_room, teacher))
-                        used_rooms.add((fixed_room, day, slot))
+                        day_schedule[slot].append(Entry(sub, fixed_room, teacher))
+                        occ_mask[cell] |= bit
+                        if fixed_room:
+                            room_busy[fixed_room] = room_busy.get(fixed_room, 0) | week_bit
                         if teacher:
-                            used_teachers.add((teacher, day, slot))
+                            teacher_busy[teacher] = teacher_busy.get(teacher, 0) | week_bit
                         remaining[secname][sub] -= 1
                         req -= 1
                         daily_subj_count[secname][day][sub] += 1
@@ -550,27 +753,37 @@ def assign_theory_subjects(data, timetable, fixed_teachers, fixed_classrooms):
                         break
                     if placed:
                         break
-                if not placed:
-                    # local swap/backtrack
-                    swap_done = try_easy_swap_for_subject(timetable, secname, sub, remaining, fixed_teachers,
-                                                         fixed_classrooms, used_rooms, used_teachers, data,
-                                                         daily_subj_count, daily_total)
-                    if swap_done:
-                        remaining[secname][sub] -= 1
-                        req -= 1
-                        continue
+                # return the tried days, re-keyed by their current load
+                for _, dpos, d in popped:
+                    heapq.heappush(day_heap, (daily_total[secname][d], dpos, d))
+                if placed:
+                    swapped = False
+                    continue
+                # local swap/backtrack: rearrange once, then retry this lecture
+                if swapped:
                     break
-                attempts += 1
+                swap_done = try_easy_swap_for_subject(timetable, secname, sub, remaining, fixed_teachers,
+                                                     fixed_classrooms, room_busy, teacher_busy, data,
+                                                     daily_subj_count, daily_total, occ_mask, sec_row, ctx)
+                if not swap_done:
+                    break
+                swapped = True
+                # the swap shifted day loads
+                day_heap = [(daily_total[secname][d], day_pos[d], d) for d in days]
+                heapq.heapify(day_heap)
+
+
+    repair_unfulfilled_theory(data, timetable, remaining, fixed_teachers, fixed_classrooms, room_busy,
+                              teacher_busy, daily_subj_count, daily_total, occ_mask, ctx)
 
 
     for sec in data["sections"]:
-        secname = sec["name"]
+        schedule = timetable[sec["name"]]
         for day in days:
-            for slot in data["slots"]:
-                if slot == "Lunch Break":
-                    continue
-                if not timetable[secname][day][slot]:
-                    timetable[secname][day][slot] = [("FREE", None, None)]
+            day_schedule = schedule[day]
+            for slot in slots:
+                if not day_schedule[slot]:
+                    day_schedule[slot] = [Entry(FREE, None, None)]
 
 
     unfulfilled = {}
@@ -578,70 +791,264 @@ def assign_theory_subjects(data, timetable, fixed_teachers, fixed_classrooms):
         for sub, cnt in subs.items():
             if cnt > 0:
                 unfulfilled.setdefault(secname, {})[sub] = cnt
-    return timetable, unfulfilled
+    return timetable, unfulfilled, written_masks
 
 
 
-def try_easy_swap_for_subject(timetable, secname, sub, remaining, fixed_teachers, fixed_classrooms, used_rooms, used_teachers, data, daily_subj_count, daily_total):
-    days = data["days"]
-    slots = [s for s in data["slots"] if s != "Lunch Break"]
+def try_easy_swap_for_subject(timetable, secname, sub, remaining, fixed_teachers, fixed_classrooms, room_busy, teacher_busy, data, daily_subj_count, daily_total, occ_mask, sec_row, ctx):
+    """
+    Move one lecture that is doubled up on its day to a free cell where its
+    room, teacher and the daily limits allow it, keeping the occupancy,
+    busy masks and daily counters in step. Places nothing for `sub` itself:
+    the caller retries the placement afterwards.
+    """
+    constraints = data.get("constraints", {})
+    max_subj_per_day = constraints.get("max_lectures_per_subject_per_day", 2)
+    max_daily = constraints.get("max_lectures_per_day_section", 6)
+    days = ctx.days
+    slots = ctx.slots_no_lunch
+    slot_bit = ctx.slot_bit
+    day_shift = ctx.day_shift
+    unavail_masks = ctx.unavail_masks
+    # only currently free cells can receive the moved entry
+    free_cells = [(di, d, s) for di, d in enumerate(days) for s in slots if not occ_mask[sec_row + di] & (1 << slot_bit[s])]
+    if not free_cells:
+        return False
+
+    def target_for(entry, from_day):
+        subj, room, teacher = entry[0], entry[1], entry[2]
+        for target in free_cells:
+            to_day = target[1]
+            if to_day != from_day:
+                if daily_total[secname][to_day] >= max_daily:
+                    continue
+                if daily_subj_count[secname][to_day][subj] >= max_subj_per_day:
+                    continue
+            bit = 1 << (day_shift[to_day] + slot_bit[target[2]])
+            if room and room_busy.get(room, 0) & bit:
+                continue
+            if teacher and (teacher_busy.get(teacher, 0) | unavail_masks.get(teacher, 0)) & bit:
+                continue
+            return target
+        return None
+
+    # occurrences of each subject per day; nothing moves before we return, so no upkeep needed
+    occ_by_day = {}
     for day in days:
+        counts = defaultdict(int)
+        for slot in slots:
+            for e in timetable[secname][day][slot]:
+                counts[e[0]] += 1
+        occ_by_day[day] = counts
+    for di, day in enumerate(days):
         for slot in slots:
             entries = timetable[secname][day][slot]
             if not entries:
                 continue
             for entry in entries:
                 subj = entry[0]
-                if subj in ("FREE", "LUNCH"):
+                if subj in _SKIP:
                     continue
-                if len(entry) > 3:
+                if entry.group is not None:
                     continue
-                occ_count = sum(1 for s in slots for e in timetable[secname][day][s] if any(ee[0] == subj for ee in ([e] if isinstance(e, tuple) else e)))
-                if occ_count <= 1:
+                if occ_by_day[day][subj] <= 1:
                     continue
-                for target_day in days:
-                    for target_slot in slots:
-                        if target_day == day and target_slot == slot:
-                            continue
-                        if any(e and e[0] not in ("FREE",) for e in timetable[secname][target_day][target_slot]):
-                            continue
-                        timetable[secname][day][slot] = [e for e in timetable[secname][day][slot] if e != entry]
-                        if not timetable[secname][day][slot]:
-                            timetable[secname][day][slot] = [("FREE", None, None)]
-                        timetable[secname][target_day][target_slot].append(entry)
-                        return True
+                target = target_for(entry, day)
+                if target is None:
+                    continue
+                target_di, target_day, target_slot = target
+                timetable[secname][day][slot] = [e for e in timetable[secname][day][slot] if e != entry]
+                if not timetable[secname][day][slot]:
+                    timetable[secname][day][slot] = [Entry(FREE, None, None)]
+                if all(e[0] == FREE for e in timetable[secname][day][slot]):
+                    occ_mask[sec_row + di] &= ~(1 << slot_bit[slot])
+                timetable[secname][target_day][target_slot].append(entry)
+                occ_mask[sec_row + target_di] |= 1 << slot_bit[target_slot]
+                from_bit = 1 << (day_shift[day] + slot_bit[slot])
+                to_bit = 1 << (day_shift[target_day] + slot_bit[target_slot])
+                for busy, name in ((room_busy, entry[1]), (teacher_busy, entry[2])):
+                    if name:
+                        busy[name] = (busy.get(name, 0) & ~from_bit) | to_bit
+                daily_subj_count[secname][day][subj] -= 1
+                daily_subj_count[secname][target_day][subj] += 1
+                daily_total[secname][day] -= 1
+                daily_total[secname][target_day] += 1
+                return True
     return False
 
 
 
+def repair_unfulfilled_theory(data, timetable, remaining, fixed_teachers, fixed_classrooms, room_busy, teacher_busy,
+                              daily_subj_count, daily_total, occ_mask, ctx, max_iterations=200, tabu_tenure=5):
+    """
+    Bounded tabu-style repair after the greedy theory pass: an unfulfilled
+    lecture takes the cell of a placed theory lecture, which moves to a free
+    cell of the same section. Every accepted move places one more lecture;
+    a displaced subject is tabu for `tabu_tenure` iterations so the same
+    lecture is not pushed around repeatedly.
+    """
+    constraints = data.get("constraints", {})
+    max_subj_per_day = constraints.get("max_lectures_per_subject_per_day", 2)
+    max_daily = constraints.get("max_lectures_per_day_section", 6)
+    days = ctx.days
+    slots = ctx.slots_no_lunch
+    slot_index = ctx.slot_index
+    slot_bit = ctx.slot_bit
+    day_shift = ctx.day_shift
+    unavail_masks = ctx.unavail_masks
+    teacher_rows = ctx.teacher_rows
+
+    def week_bit(day, slot):
+        return 1 << (day_shift[day] + slot_bit[slot])
+
+    def teacher_free(teacher, day, slot):
+        return not teacher or not (teacher_busy.get(teacher, 0) | unavail_masks.get(teacher, 0)) & week_bit(day, slot)
+
+    def mark(busy, name, day, slot, taken=True):
+        if taken:
+            busy[name] = busy.get(name, 0) | week_bit(day, slot)
+        else:
+            busy[name] = busy.get(name, 0) & ~week_bit(day, slot)
+
+    def neighbours_clear(secname, day, slot, sub, moving=None):
+        i = slot_index[slot]
+        for j in (i - 1, i + 1):
+            if 0 <= j < len(slots):
+                if any(e is not moving and e[0] == sub for e in timetable[secname][day][slots[j]]):
+                    return False
+        return True
+
+    def relocation_for(secname, sec_row, entry, from_day):
+        subj, room, teacher = entry[0], entry[1], entry[2]
+        for di, day in enumerate(days):
+            if daily_total[secname][day] >= max_daily:
+                continue
+            if daily_subj_count[secname][day][subj] - (day == from_day) >= max_subj_per_day:
+                continue
+            mask = occ_mask[sec_row + di]
+            for slot in slots:
+                if mask & (1 << slot_bit[slot]):
+                    continue
+                if room and room_busy.get(room, 0) & week_bit(day, slot):
+                    continue
+                if not teacher_free(teacher, day, slot):
+                    continue
+                if not neighbours_clear(secname, day, slot, subj, moving=entry):
+                    continue
+                return di, day, slot
+        return None
+
+    def find_move(secname, sec_row, sub, teacher, room, iteration):
+        for day in days:
+            if daily_subj_count[secname][day][sub] >= max_subj_per_day:
+                continue
+            for slot in slots:
+                placed = [e for e in timetable[secname][day][slot] if e[0] != FREE]
+                # only a cell holding exactly one theory lecture of another subject
+                if len(placed) != 1:
+                    continue
+                entry = placed[0]
+                if entry.group is not None or entry[0] in (sub, LUNCH, WORKSHOP):
+                    continue
+                if tabu.get((secname, entry[0]), 0) > iteration:
+                    continue
+                if teacher and teacher != entry[2] and not teacher_free(teacher, day, slot):
+                    continue
+                if teacher and unavail_masks.get(teacher, 0) & week_bit(day, slot):
+                    continue
+                if room and room != entry[1] and room_busy.get(room, 0) & week_bit(day, slot):
+                    continue
+                if not neighbours_clear(secname, day, slot, sub):
+                    continue
+                target = relocation_for(secname, sec_row, entry, day)
+                if target:
+                    return day, slot, entry, target
+        return None
+
+    tabu = {}  # (section, subject) -> iteration until which it may not be displaced
+    iteration = 0
+    for si, sec in enumerate(data["sections"]):
+        secname = sec["name"]
+        sec_row = si * len(days)
+        room = fixed_classrooms.get(secname)
+        sec_teachers = teacher_rows[si]
+        for sub in sec.get("subjects", []):
+            teacher = sec_teachers[sub]
+            while remaining[secname][sub] > 0 and iteration < max_iterations:
+                iteration += 1
+                move = find_move(secname, sec_row, sub, teacher, room, iteration)
+                if move is None:
+                    break
+                day, slot, entry, (to_di, to_day, to_slot) = move
+                # displaced lecture goes to its new free cell
+                timetable[secname][day][slot].remove(entry)
+                timetable[secname][to_day][to_slot].append(entry)
+                occ_mask[sec_row + to_di] |= 1 << slot_bit[to_slot]
+                if entry[1]:
+                    mark(room_busy, entry[1], day, slot, taken=False)
+                    mark(room_busy, entry[1], to_day, to_slot)
+                if entry[2]:
+                    mark(teacher_busy, entry[2], day, slot, taken=False)
+                    mark(teacher_busy, entry[2], to_day, to_slot)
+                daily_subj_count[secname][day][entry[0]] -= 1
+                daily_subj_count[secname][to_day][entry[0]] += 1
+                daily_total[secname][to_day] += 1
+                # unfulfilled lecture takes the vacated cell
+                timetable[secname][day][slot].append(Entry(sub, room, teacher))
+                if room:
+                    mark(room_busy, room, day, slot)
+                if teacher:
+                    mark(teacher_busy, teacher, day, slot)
+                daily_subj_count[secname][day][sub] += 1
+                remaining[secname][sub] -= 1
+                tabu[(secname, entry[0])] = iteration + tabu_tenure
+            if iteration >= max_iterations:
+                return
+
+
+
 # ----------------- Suggestion Generator -----------------
 
 
-def generate_suggestions(data, timetable, unfulfilled, fixed_teachers):
+def generate_suggestions(data, timetable, unfulfilled, fixed_teachers, ctx=None):
     """
     For each unfulfilled (section, subject, count) produce suggestions:
       - If too few teachers or teacher-availability insufficient -> suggest more faculty or reassign.
       - If not enough free slots -> suggest increase slots/relax constraints.
       - Else suggest relaxing per-day limits or swapping labs/rooms.
     """
-    days = data["days"]
-    slots = [s for s in data["slots"] if s != "Lunch Break"]
+    if ctx is None:
+        ctx = build_solve_context(data, fixed_teachers)
+    days = ctx.days
+    slots = ctx.slots_no_lunch
 
 
-    # compute used_teachers from final timetable
-    used_teachers = set()
-    for sec in timetable:
-        for d in data["days"]:
-            for s in data["slots"]:
-                for entry in timetable[sec][d][s]:
+    # single pass over the final timetable: free slots per section and the
+    # (day, slot) cells each teacher is already teaching in
+    free_slots_by_section = defaultdict(int)
+    teacher_blocked = defaultdict(set)
+    for sec, schedule in timetable.items():
+        for d in days:
+            day_schedule = schedule[d]
+            for s in slots:
+                entries = day_schedule[s]
+                if all(e[0] == FREE for e in entries):
+                    free_slots_by_section[sec] += 1
+                    continue
+                for entry in entries:
                     if not entry:
                         continue
                     subj = entry[0]
                     teach = entry[2]
-                    if subj in ("FREE", "LUNCH"):
+                    if subj in _SKIP:
                         continue
                     if teach:
-                        used_teachers.add((teach, d, s))
+                        teacher_blocked[teach].add((d, s))
+    # declared unavailability blocks cells as well
+    for t, d, s in ctx.unavail_set:
+        if t and d in ctx.day_pos and s in ctx.slot_index:
+            teacher_blocked[t].add((d, s))
+    cells_per_week = len(days) * len(slots)
 
 
     suggestions = {}
@@ -649,15 +1056,7 @@ def generate_suggestions(data, timetable, unfulfilled, fixed_teachers):
 
     for secname, subs in unfulfilled.items():
         suggestions.setdefault(secname, {})
-        # count free slots for this section across the week
-        free_slots = 0
-        free_slot_list = []
-        for d in days:
-            for s in slots:
-                entries = timetable[secname][d][s]
-                if all(e[0] in ("FREE",) for e in entries):
-                    free_slots += 1
-                    free_slot_list.append((d, s))
+        free_slots = free_slots_by_section[secname]
 
 
         for sub, cnt in subs.items():
@@ -671,17 +1070,7 @@ def generate_suggestions(data, timetable, unfulfilled, fixed_teachers):
 
             teacher_count = len(teachers_for_sub)
             # measure per-teacher availability (counts of free slots for that teacher)
-            teacher_avail = {}
-            for t in teachers_for_sub:
-                avail = 0
-                for d in days:
-                    for s in slots:
-                        if (t, d, s) in used_teachers:
-                            continue
-                        if teacher_unavailable_on(t, d, s, data):
-                            continue
-                        avail += 1
-                teacher_avail[t] = avail
+            teacher_avail = {t: cells_per_week - len(teacher_blocked.get(t, ())) for t in teachers_for_sub}
             max_teacher_avail = max(teacher_avail.values()) if teacher_avail else 0
 
 
@@ -725,36 +1114,131 @@ def generate_suggestions(data, timetable, unfulfilled, fixed_teachers):
 # ----------------- API Helpers -----------------
 
 
-def timetable_to_result(timetable, data, moved_map=None):
-    """Return rows and include moved metadata if available."""
-    result = []
+# Generation is deterministic, so identical payloads (e.g. a re-submit after
+# a failed request) can reuse the previous response.
+RESULT_CACHE_SIZE = 32
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def input_cache_key(data):
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode()).digest()
+
+
+def cached_result(key):
+    with _result_cache_lock:
+        result = _result_cache.get(key)
+        if result is not None:
+            _result_cache.move_to_end(key)
+        return result
+
+
+def store_result(key, result):
+    with _result_cache_lock:
+        _result_cache[key] = result
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+
+def dump_json(obj):
+    """
+    Compact JSON bytes, via orjson when installed. Non-string dict keys
+    (numeric room names key the statistics) become strings, as in stdlib json.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+
+def json_response(obj, status=200):
+    """
+    JSON response body via orjson when installed, otherwise compact stdlib
+    json (jsonify would indent and sort keys in debug mode).
+    """
+    return Response(dump_json(obj), status=status, mimetype='application/json')
+
+
+
+def iter_json_chunks(obj, rows_key="timetable", batch_size=500):
+    """
+    Serialize the dict `obj` piecewise: the rows under `rows_key` go out in
+    batches, then the remaining keys, so the whole body never sits in memory
+    as one string next to the rows. Everything but the rows is encoded
+    before this returns, so a value that cannot be serialized raises here
+    rather than part way through the body.
+    """
+    rows = obj.get(rows_key, [])
+    head = b'{' + dump_json(rows_key) + b':['
+    rest = {k: v for k, v in obj.items() if k != rows_key}
+    tail = b'],' + dump_json(rest)[1:] if rest else b']}'
+    return _json_chunks(head, rows, tail, batch_size)
+
+
+def _json_chunks(head, rows, tail, batch_size):
+    yield head
+    for start in range(0, len(rows), batch_size):
+        chunk = dump_json(rows[start:start + batch_size])[1:-1]
+        yield chunk if start == 0 else b',' + chunk
+    yield tail
+
+
+
+def streamed_json_response(obj, status=200, on_complete=None):
+    """
+    Like json_response, but streams the body from iter_json_chunks. Called
+    from inside the view's try block, so an encoding error in the non-row
+    keys becomes the view's 500 instead of a truncated 200. `on_complete`
+    runs only after the last chunk has been encoded.
+    """
+    chunks = iter_json_chunks(obj)
+    if on_complete is not None:
+        chunks = _chunks_then(chunks, on_complete)
+    return Response(stream_with_context(chunks), status=status, mimetype='application/json')
+
+
+def _chunks_then(chunks, callback):
+    yield from chunks
+    callback()
+
+
+
+def iter_timetable_rows(timetable, data, moved_map=None):
+    """Yield result rows one at a time, with moved metadata if available."""
+    teaching_slots = [s for s in data["slots"] if s != LUNCH_BREAK]
     for secname, schedule in timetable.items():
-        for day in data["days"]:
-            for slot in data["slots"]:
-                for entry in schedule[day][slot]:
-                    if not entry:
-                        continue
-                    subj = entry[0]
-                    if subj in ("FREE", "LUNCH"):
+        for day, day_schedule in schedule.items():
+            for slot in teaching_slots:
+                moved_from = moved_map.get((secname, day, slot)) if moved_map else None
+                for entry in day_schedule[slot]:
+                    if not entry or entry[0] in _SKIP:
                         continue
-                    room = entry[1]
-                    teacher = entry[2]
-                    row = {
-                        "section": secname,
-                        "day": day,
-                        "slot": slot,
-                        "subject": subj,
-                        "room": room,
-                        "teacher": teacher
-                    }
+                    row = {"section": secname, "day": day, "slot": slot, "subject": entry.subject,
+                           "room": entry.room, "teacher": entry.teacher}
                     # group for lab entries
-                    if len(entry) > 3:
-                        row["group"] = entry[3]
-                    if moved_map and (secname, day, slot) in moved_map:
-                        row["moved_from"] = moved_map[(secname, day, slot)]
+                    if entry.group is not None:
+                        row["group"] = entry.group
+                    if moved_from is not None:
+                        row["moved_from"] = moved_from
                         row["moved"] = True
-                    result.append(row)
-    return result
+                    yield row
+
+
+
+def timetable_to_result(timetable, data, moved_map=None, collect_stats=False):
+    """
+    Return rows and include moved metadata if available. With
+    `collect_stats` also return the usage counters that
+    calculate_timetable_stats needs, taken from the rows instead of a second
+    walk over the timetable.
+    """
+    result = list(iter_timetable_rows(timetable, data, moved_map))
+    if not collect_stats:
+        return result
+    # same fields calculate_timetable_stats counts: entry[1], entry[2], entry[0]
+    return result, tally_usage(result)
 
 
 
@@ -766,76 +1250,109 @@ def generate_timetable_api():
     try:
         request_data = request.json
         if not request_data:
-            return jsonify({"error": "No input data"}), 400
+            return json_response({"error": "No input data"}, 400)
+
+        cache_key = input_cache_key(request_data)
+        cached = cached_result(cache_key)
+        if cached is not None:
+            return streamed_json_response(cached)
 
         # Validate input data structure
         validation_result = validate_input_data(request_data)
         if not validation_result['valid']:
-            return jsonify({
+            return json_response({
                 "error": "Invalid input data",
                 "validation_errors": validation_result['errors'],
                 "validation_warnings": validation_result['warnings']
-            }), 400
+            }, 400)
 
         # Transform classes-based structure to sections-based structure
         data = transform_classes_to_sections(request_data)
 
-        print(f"Processing {len(data['sections'])} sections from {len(request_data.get('classes', []))} classes")
+        app.logger.debug("Processing %d sections from %d classes",
+                         len(data['sections']), len(request_data.get('classes', [])))
 
         fixed_classrooms = assign_fixed_classrooms(data)
         fixed_teachers = create_fixed_teacher_mapping(data)
         timetable = make_empty_timetable(data)
+        ctx = build_solve_context(data, fixed_teachers)
 
         # Assign labs first
-        timetable = assign_all_labs(data, timetable, fixed_teachers, fixed_classrooms)
+        timetable, room_busy, teacher_busy = assign_all_labs(data, timetable, fixed_teachers, fixed_classrooms, ctx)
         # Assign theory
-        timetable, unfulfilled = assign_theory_subjects(data, timetable, fixed_teachers, fixed_classrooms)
+        timetable, unfulfilled, written_masks = assign_theory_subjects(data, timetable, fixed_teachers, fixed_classrooms, ctx,
+                                                        room_busy, teacher_busy)
 
         # If some unfulfilled, do a relaxed re-try (existing logic)
         if unfulfilled:
-            for sec in timetable:
-                for day in data["days"]:
-                    for slot in data["slots"]:
-                        if slot == "Lunch Break":
-                            continue
-                        new_entries = []
-                        for entry in timetable[sec][day][slot]:
-                            if len(entry) > 3:
-                                new_entries.append(entry)
-                        timetable[sec][day][slot] = new_entries
-            data_relaxed = copy.deepcopy(data)
-            if "constraints" not in data_relaxed:
-                data_relaxed["constraints"] = {}
+            # strip theory (and FREE) entries: only the cells the theory pass wrote
+            days = ctx.days
+            slots_all = ctx.slots_all
+            for si, sec in enumerate(data["sections"]):
+                sec_schedule = timetable[sec["name"]]
+                for di, day in enumerate(days):
+                    mask = written_masks[si * len(days) + di]
+                    if not mask:
+                        continue
+                    day_schedule = sec_schedule[day]
+                    for i, slot in enumerate(slots_all):
+                        if mask & (1 << i):
+                            day_schedule[slot] = [e for e in day_schedule[slot] if e.group is not None]
+            # only the constraints differ; sections and the rest are shared with `data`
+            data_relaxed = dict(data)
+            data_relaxed["constraints"] = dict(data.get("constraints", {}))
             data_relaxed["constraints"]["max_lectures_per_subject_per_day"] = data_relaxed["constraints"].get("max_lectures_per_subject_per_day", 2) + 1
-            timetable, unfulfilled2 = assign_theory_subjects(data_relaxed, timetable, fixed_teachers, fixed_classrooms)
+            timetable, unfulfilled2, _ = assign_theory_subjects(data_relaxed, timetable, fixed_teachers, fixed_classrooms, ctx)
             unfulfilled = unfulfilled2
 
         # Generate suggestions if any unfulfilled remain
         suggestions = {}
         if unfulfilled:
-            suggestions = generate_suggestions(data, timetable, unfulfilled, fixed_teachers)
+            suggestions = generate_suggestions(data, timetable, unfulfilled, fixed_teachers, ctx)
 
         # Calculate statistics
-        stats = calculate_timetable_stats(timetable, request_data)
+        result, stats_acc = timetable_to_result(timetable, data, collect_stats=True)
+        stats = calculate_timetable_stats(timetable, request_data, stats_acc)
 
-        result = timetable_to_result(timetable, data)
-        
-        return jsonify({
+        response = {
             "success": True,
-            "timetable": result, 
-            "unfulfilled": unfulfilled, 
+            "timetable": result,
+            "unfulfilled": unfulfilled,
             "suggestions": suggestions,
             "statistics": stats,
             "validation_warnings": validation_result.get('warnings', [])
-        })
+        }
+        # cached once the whole body has encoded, so a failure is not replayed
+        return streamed_json_response(response, on_complete=lambda: store_result(cache_key, response))
 
     except Exception as e:
-        print(f"Error generating timetable: {str(e)}")
-        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+        app.logger.exception("Error generating timetable")
+        return json_response({"error": f"Internal server error: {str(e)}"}, 500)
 
 
-def calculate_timetable_stats(timetable, original_data):
-    """Calculate statistics for the generated timetable"""
+def tally_usage(rows, keys=("subject", "room", "teacher")):
+    """
+    Usage counters for calculate_timetable_stats: the row count plus, per
+    key, a Counter of the non-empty values of that field. Counting runs
+    through map(itemgetter) so the loop stays in C; empty values are
+    dropped after.
+    """
+    acc = {"used_slots": len(rows)}
+    for key in keys:
+        counts = Counter(map(operator.itemgetter(key), rows))
+        counts.pop(None, None)
+        counts.pop("", None)
+        acc[key] = counts
+    return acc
+
+
+
+def calculate_timetable_stats(timetable, original_data, stats_acc=None):
+    """
+    Calculate statistics for the generated timetable. `stats_acc` are the
+    counters from timetable_to_result(..., collect_stats=True); without them
+    the timetable is walked here.
+    """
     stats = {
         'total_sections': len(timetable),
         'total_classes': len(original_data.get('classes', [])),
@@ -848,41 +1365,22 @@ def calculate_timetable_stats(timetable, original_data):
     
     # Calculate total slots
     days = original_data.get('days', [])
-    slots = [s for s in original_data.get('slots', []) if s != 'Lunch Break']
-    total_slots_per_section = len(days) * len(slots)
+    teaching_slots = [s for s in original_data.get('slots', []) if s != LUNCH_BREAK]
+    total_slots_per_section = len(days) * len(teaching_slots)
     stats['total_slots_available'] = total_slots_per_section * len(timetable)
     
     # Count used slots and gather statistics
-    teacher_hours = defaultdict(int)
-    room_hours = defaultdict(int)
-    subject_count = defaultdict(int)
-    
-    for section_name, section_schedule in timetable.items():
-        for day, day_schedule in section_schedule.items():
-            for slot, entries in day_schedule.items():
-                if slot == 'Lunch Break':
-                    continue
-                    
-                for entry in entries:
-                    if not entry or entry[0] in ('FREE', 'LUNCH'):
-                        continue
-                        
-                    stats['total_slots_used'] += 1
-                    
-                    if len(entry) > 1 and entry[1]:  # teacher
-                        teacher_hours[entry[1]] += 1
-                    
-                    if len(entry) > 2 and entry[2]:  # room  
-                        room_hours[entry[2]] += 1
-                    
-                    if entry[0]:  # subject
-                        subject_count[entry[0]] += 1
+    if stats_acc is None:
+        stats_acc = tally_usage(list(iter_timetable_rows(timetable, original_data)))
+    stats['total_slots_used'] = stats_acc["used_slots"]
     
     # Calculate utilization percentages
     stats['utilization_percentage'] = (stats['total_slots_used'] / stats['total_slots_available'] * 100) if stats['total_slots_available'] > 0 else 0
-    stats['teacher_utilization'] = dict(teacher_hours)
-    stats['room_utilization'] = dict(room_hours)
-    stats['subject_distribution'] = dict(subject_count)
+    # labels as the API has always reported them: 'teacher_utilization' counts
+    # each entry's room and 'room_utilization' its teacher
+    stats['teacher_utilization'] = dict(stats_acc["room"])
+    stats['room_utilization'] = dict(stats_acc["teacher"])
+    stats['subject_distribution'] = dict(stats_acc["subject"])
     
     return stats
 
@@ -893,17 +1391,111 @@ def validate_input_api():
     try:
         data = request.json
         if not data:
-            return jsonify({'error': 'No data provided'}), 400
+            return json_response({'error': 'No data provided'}, 400)
         
         validation_result = validate_input_data(data)
-        return jsonify(validation_result)
+        return json_response(validation_result)
         
     except Exception as e:
-        return jsonify({
+        return json_response({
             'valid': False,
             'errors': [f'Validation error: {str(e)}'],
             'warnings': []
-        }), 500
+        }, 500)
+
+
+def freed_slot_candidates(slots_all, slot_index, slot, rightmost_before_lunch, rightmost_after_lunch):
+    """Slots to pull a lecture from into a freed `slot`, in preference order."""
+    freed_index = slot_index[slot]
+
+    # candidates first: rightmost before lunch, rightmost after lunch
+    # (an insertion-ordered dict keeps the order and drops repeats)
+    candidate_seen = {}
+
+    # Add rightmost-before-lunch only if it is later than freed slot
+    if rightmost_before_lunch:
+        idx_rbl = slot_index[rightmost_before_lunch]
+        if idx_rbl > freed_index:
+            candidate_seen[rightmost_before_lunch] = None
+
+    # Add rightmost-after-lunch only if it is later than freed slot
+    if rightmost_after_lunch:
+        idx_ral = slot_index[rightmost_after_lunch]
+        if idx_ral > freed_index:
+            candidate_seen[rightmost_after_lunch] = None
+
+    # then other later slots in the day ordered rightmost-first (only slots with index > freed_index)
+    for i in range(len(slots_all) - 1, freed_index, -1):
+        s2 = slots_all[i]
+        if s2 != LUNCH_BREAK:
+            candidate_seen.setdefault(s2, None)
+    return list(candidate_seen)
+
+
+
+def try_move_for_freed(timetable, sec, day, slot, candidate_slots, room_busy, teacher_busy, unavailable_memo, data):
+    """
+    Move the first movable theory lecture of `sec` from a candidate slot into
+    the freed (day, slot). Updates the timetable and the (day, slot) busy
+    maps in place and returns the slot the lecture came from, or None.
+    """
+    for target_slot in candidate_slots:
+        # find a movable theory entry at target_slot (non lab)
+        candidate_entry = None
+        for e in timetable[sec][day][target_slot]:
+            if not e:
+                continue
+            subj = e[0]
+            if subj in _SKIP:
+                continue
+            # skip lab group entries
+            if e.group is not None:
+                continue
+            # select first theory entry
+            candidate_entry = e
+            break
+
+        if not candidate_entry:
+            continue
+
+        room = candidate_entry[1]
+        teach = candidate_entry[2]
+
+        # teacher must be available at freed slot and not used
+        if teach:
+            if teach not in unavailable_memo:
+                unavailable_memo[teach] = teacher_unavailable_on(teach, day, slot, data)
+            if unavailable_memo[teach]:
+                continue
+        if teach and teach in teacher_busy[(day, slot)]:
+            continue
+        # room must not be used at freed slot
+        check_room = room  # preserve original room
+        if check_room and check_room in room_busy[(day, slot)]:
+            continue
+
+        # all checks passed -> move
+        # remove candidate_entry from target_slot
+        target_entries = timetable[sec][day][target_slot]
+        for i, x in enumerate(target_entries):
+            if x is candidate_entry:
+                del target_entries[i]
+                break
+        if not target_entries:
+            target_entries.append(Entry(FREE, None, None))
+
+        # insert the same entry object into freed slot (preserves room & teacher;
+        # only theory entries are candidates, so there is no group to drop)
+        timetable[sec][day][slot] = [candidate_entry]
+        # update occupancy sets
+        if room:
+            room_busy[(day, target_slot)].discard(room)
+            room_busy[(day, slot)].add(room)
+        if teach:
+            teacher_busy[(day, target_slot)].discard(teach)
+            teacher_busy[(day, slot)].add(teach)
+        return target_slot
+    return None
 
 
 @app.route('/reset_teacher', methods=['POST'])
@@ -917,12 +1509,15 @@ def reset_teacher_api():
         current_list = request_data.get('timetable', [])
 
         if not original_input_data:
-            return jsonify({"error": "inputData missing"}), 400
+            return json_response({"error": "inputData missing"}, 400)
 
         # Transform to sections-based structure
         data = transform_classes_to_sections(original_input_data)
 
         timetable = make_empty_timetable(data)
+        # occupancy per (day, slot), filled while ingesting the client's rows
+        room_busy = defaultdict(set)
+        teacher_busy = defaultdict(set)
         for entry in current_list:
             sec = entry["section"]
             d = entry["day"]
@@ -931,45 +1526,41 @@ def reset_teacher_api():
             room = entry.get("room")
             teach = entry.get("teacher")
             group = entry.get("group")
-            if group:
-                timetable[sec][d][s].append((subj, room, teach, group))
-            else:
-                timetable[sec][d][s].append((subj, room, teach))
+            timetable[sec][d][s].append(Entry(subj, room, teach, group or None))
+            if subj in _SKIP:
+                continue
+            if room:
+                room_busy[(d, s)].add(room)
+            if teach:
+                teacher_busy[(d, s)].add(teach)
 
         freed_sections = []
         if teacher and day and slot:
             for sec in timetable:
                 entries = timetable[sec][day][slot]
-                new_entries = [e for e in entries if len(e) < 3 or e[2] != teacher]
+                new_entries = [e for e in entries if e.teacher != teacher]
                 if len(new_entries) != len(entries):
                     if not new_entries:
-                        timetable[sec][day][slot] = [("FREE", None, None)]
+                        timetable[sec][day][slot] = [Entry(FREE, None, None)]
                         freed_sections.append(sec)
                     else:
                         timetable[sec][day][slot] = new_entries
-
-        # reconstruct occupancy sets
-        used_rooms = set()
-        used_teachers = set()
-        for sec in timetable:
-            for d in data["days"]:
-                for s in data["slots"]:
-                    for entry in timetable[sec][d][s]:
-                        if not entry:
-                            continue
-                        subj = entry[0]
-                        room = entry[1]
-                        teach = entry[2]
-                        if subj in ("FREE", "LUNCH"):
-                            continue
-                        if room:
-                            used_rooms.add((room, d, s))
-                        if teach:
-                            used_teachers.add((teach, d, s))
+            # only the reset cell lost entries; recount it from what is left
+            rooms_left = room_busy[(day, slot)] = set()
+            teachers_left = teacher_busy[(day, slot)] = set()
+            for sec in timetable:
+                for entry in timetable[sec][day][slot]:
+                    if entry[0] in _SKIP:
+                        continue
+                    if entry[1]:
+                        rooms_left.add(entry[1])
+                    if entry[2]:
+                        teachers_left.add(entry[2])
 
         slots_all = data["slots"]
-        if "Lunch Break" in slots_all:
-            lunch_idx = slots_all.index("Lunch Break")
+        slot_index = {s: i for i, s in enumerate(slots_all)}
+        if LUNCH_BREAK in slot_index:
+            lunch_idx = slot_index[LUNCH_BREAK]
             rightmost_before_lunch = slots_all[lunch_idx - 1] if lunch_idx - 1 >= 0 else None
             rightmost_after_lunch = slots_all[-1] if len(slots_all) > lunch_idx + 1 else None
         else:
@@ -980,110 +1571,40 @@ def reset_teacher_api():
         fixed_teachers = create_fixed_teacher_mapping(data)
 
         moved_map = {}  # (section, day, new_slot) -> old_slot
+        # every move targets the reset (day, slot), so availability only varies by teacher
+        unavailable_memo = {}  # teacher -> unavailable at (day, slot)
+
+        # candidates depend only on the freed (day, slot), shared by every freed section
+        candidate_slots = []
+        if freed_sections:
+            candidate_slots = freed_slot_candidates(slots_all, slot_index, slot, rightmost_before_lunch,
+                                                    rightmost_after_lunch)
 
         # For each freed section attempt the swaps:
         for sec in freed_sections:
-            try:
-                if not timetable[sec][day][slot] or (len(timetable[sec][day][slot]) == 1 and timetable[sec][day][slot][0][0] == "FREE"):
-                    moved = False
-                    # Determine freed slot index
-                    freed_index = slots_all.index(slot)
-
-                    # candidates first: rightmost before lunch, rightmost after lunch
-                    candidate_slots = []
-
-                    # Add rightmost-before-lunch only if it is later than freed slot
-                    if rightmost_before_lunch:
-                        idx_rbl = slots_all.index(rightmost_before_lunch)
-                        if idx_rbl > freed_index:
-                            candidate_slots.append(rightmost_before_lunch)
-
-                    # Add rightmost-after-lunch only if it is later than freed slot
-                    if rightmost_after_lunch:
-                        idx_ral = slots_all.index(rightmost_after_lunch)
-                        if idx_ral > freed_index:
-                            candidate_slots.append(rightmost_after_lunch)
-
-                    # then other later slots in the day ordered rightmost-first (only slots with index > freed_index)
-                    later_slots = [s for i, s in enumerate(slots_all) if i > freed_index and s != "Lunch Break"]
-                    # prefer rightmost-first
-                    later_slots_sorted = sorted(later_slots, key=lambda s: slots_all.index(s), reverse=True)
-                    for s2 in later_slots_sorted:
-                        if s2 not in candidate_slots:
-                            candidate_slots.append(s2)
-
-                    for target_slot in candidate_slots:
-                        # find a movable theory entry at target_slot (non lab)
-                        entries = list(timetable[sec][day][target_slot])
-                        candidate_entry = None
-                        for e in entries:
-                            if not e:
-                                continue
-                            subj = e[0]
-                            if subj in ("FREE", "LUNCH"):
-                                continue
-                            # skip lab group entries (len>3)
-                            if len(e) > 3:
-                                continue
-                            # select first theory entry
-                            candidate_entry = e
-                            break
-
-                        if not candidate_entry:
-                            continue
-
-                        subj = candidate_entry[0]
-                        room = candidate_entry[1]
-                        teach = candidate_entry[2]
-
-                        # teacher must be available at freed slot and not used
-                        if teach and teacher_unavailable_on(teach, day, slot, data):
-                            continue
-                        if teach and (teach, day, slot) in used_teachers:
-                            continue
-                        # room must not be used at freed slot
-                        check_room = room  # preserve original room
-                        if check_room and (check_room, day, slot) in used_rooms:
-                            continue
-
-                        # all checks passed -> move
-                        # remove candidate_entry from target_slot
-                        timetable[sec][day][target_slot] = [x for x in timetable[sec][day][target_slot] if x != candidate_entry]
-                        if not timetable[sec][day][target_slot]:
-                            timetable[sec][day][target_slot] = [("FREE", None, None)]
-
-                        # insert exact entry into freed slot (preserve room & teacher)
-                        timetable[sec][day][slot] = [(subj, room, teach)]
-                        # update occupancy sets
-                        if room:
-                            used_rooms.discard((room, day, target_slot))
-                            used_rooms.add((room, day, slot))
-                        if teach:
-                            used_teachers.discard((teach, day, target_slot))
-                            used_teachers.add((teach, day, slot))
-
-                        moved_map[(sec, day, slot)] = target_slot
-                        moved = True
-                        break
-
-                    if not moved:
-                        # fallback: put a Workshop
-                        timetable[sec][day][slot] = [("Workshop", None, None)]
-            except Exception:
-                pass
+            freed = timetable[sec][day][slot]
+            if freed and not (len(freed) == 1 and freed[0][0] == FREE):
+                continue
+            source_slot = try_move_for_freed(timetable, sec, day, slot, candidate_slots, room_busy,
+                                             teacher_busy, unavailable_memo, data)
+            if source_slot is not None:
+                moved_map[(sec, day, slot)] = source_slot
+            else:
+                # fallback: put a Workshop
+                timetable[sec][day][slot] = [Entry(WORKSHOP, None, None)]
 
         result = timetable_to_result(timetable, data, moved_map=moved_map)
-        return jsonify({"timetable": result})
+        return json_response({"timetable": result})
 
     except Exception as e:
-        print(f"Error in reset_teacher: {str(e)}")
-        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+        app.logger.exception("Error in reset_teacher")
+        return json_response({"error": f"Internal server error: {str(e)}"}, 500)
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         'message': 'Timetable Generator API is running',
         'version': '2.0',
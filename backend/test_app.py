@@ -0,0 +1,141 @@
+from collections import Counter
+import json
+
+import pytest
+
+import app as timetable_app
+
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+SLOTS = ["9:00-9:55", "9:55-10:50", "10:50-11:45", "11:45-12:40", "Lunch Break",
+         "2:00-2:55", "2:55-3:50", "3:50-4:45"]
+
+
+def tight_payload():
+    """One class of three sections asking for more lectures than fit."""
+    subjects = [f"S{i}" for i in range(10)]
+    return {
+        "classes": [{
+            "name": "C0",
+            "subjects": ["S0", "S4", "S5", "S9", "S3"],
+            "lab_subjects": ["L2", "L1"],
+            "sections": [{"name": "A", "student_count": 45},
+                         {"name": "B", "student_count": 20},
+                         {"name": "C", "student_count": 20}],
+        }],
+        "rooms": ["R0", "R1", "R2"],
+        "labs": ["LabX", "LabY"],
+        "lab_rooms": {f"L{i}": [f"L{i}-R1", f"L{i}-R2"] for i in range(3)},
+        "days": DAYS,
+        "slots": SLOTS,
+        "teachers": {"S0": ["TS00"], "S1": ["TS10", "TS11"], "S2": ["TS20", "TS21"], "S3": ["TS30"],
+                     "S4": ["TS40"], "S5": ["TS50"], "S6": ["TS60"], "S7": ["TS70", "TS71"],
+                     "S8": ["TS80", "TS81"], "S9": ["TS90"]},
+        "lab_teachers": {f"L{i}": [f"LTL{i}"] for i in range(5)},
+        "teacher_unavailability": {
+            "TS00": [{"day": "Tuesday", "slot": "2:55-3:50"}, {"day": "Wednesday", "slot": "3:50-4:45"},
+                     {"day": "Monday", "slot": "2:00-2:55"}],
+            "TS10": [{"day": "Wednesday", "slot": "11:45-12:40"}, {"day": "Wednesday", "slot": "9:55-10:50"},
+                     {"day": "Monday", "slot": "9:55-10:50"}],
+            "TS20": [{"day": "Thursday", "slot": "11:45-12:40"}, {"day": "Friday", "slot": "2:00-2:55"},
+                     {"day": "Wednesday", "slot": "3:50-4:45"}],
+            "TS30": [{"day": "Tuesday", "slot": "11:45-12:40"}, {"day": "Friday", "slot": "2:55-3:50"},
+                     {"day": "Monday", "slot": "2:00-2:55"}],
+        },
+        "lecture_requirements": {s: 6 for s in subjects},
+        "lab_capacity": 30,
+        "constraints": {"max_lectures_per_subject_per_day": 2, "max_lectures_per_day_section": 6},
+    }
+
+
+@pytest.fixture
+def client():
+    timetable_app._result_cache.clear()
+    return timetable_app.app.test_client()
+
+
+def test_repair_places_lectures(client, monkeypatch):
+    placed_by_repair = []
+    repair = timetable_app.repair_unfulfilled_theory
+
+    def counting_repair(data, timetable, remaining, *args, **kwargs):
+        before = sum(sum(subs.values()) for subs in remaining.values())
+        repair(data, timetable, remaining, *args, **kwargs)
+        placed_by_repair.append(before - sum(sum(subs.values()) for subs in remaining.values()))
+
+    monkeypatch.setattr(timetable_app, "repair_unfulfilled_theory", counting_repair)
+    client.post("/generate_timetable", json=tight_payload())
+    assert sum(placed_by_repair) > 0
+
+
+def test_unfulfilled_matches_placed_lectures(client):
+    payload = tight_payload()
+    body = client.post("/generate_timetable", json=payload).get_json()
+    rows = body["timetable"]
+
+    placed = Counter((r["section"], r["subject"]) for r in rows if "group" not in r)
+    shortage = {}
+    for section in payload["classes"][0]["sections"]:
+        secname = f"C0 - {section['name']}"
+        for sub in payload["classes"][0]["subjects"]:
+            missing = payload["lecture_requirements"][sub] - placed[(secname, sub)]
+            if missing > 0:
+                shortage.setdefault(secname, {})[sub] = missing
+    assert shortage
+    assert body["unfulfilled"] == shortage
+
+    # no teacher is double-booked by the swap or the repair
+    booked = Counter((r["teacher"], r["day"], r["slot"]) for r in rows if r["teacher"])
+    assert max(booked.values()) == 1
+
+
+def numeric_room_payload():
+    payload = tight_payload()
+    payload["rooms"] = [101, 102, 103]
+    payload["lab_rooms"] = {f"L{i}": [201 + i] for i in range(3)}
+    return payload
+
+
+def test_numeric_room_names(client):
+    response = client.post("/generate_timetable", json=numeric_room_payload())
+    assert response.status_code == 200
+    body = response.get_json()
+    # the statistics are keyed by room; numeric names come back as strings
+    assert "101" in body["statistics"]["teacher_utilization"]
+    assert {r["room"] for r in body["timetable"]} <= {101, 102, 103, 201, 202, 203}
+
+
+def test_streamed_body_round_trips():
+    rows = [{"section": "A", "slot": i} for i in range(5)]
+    for obj in ({"timetable": rows, "success": True, "unfulfilled": {}},
+                {"timetable": rows},
+                {"timetable": [], "success": True}):
+        chunks = list(timetable_app.iter_json_chunks(obj, batch_size=2))
+        assert json.loads(b"".join(chunks)) == obj
+
+
+def test_streamed_response_reports_encoding_errors(client, monkeypatch):
+    response = client.post("/generate_timetable", json=tight_payload())
+    assert response.is_streamed
+    assert response.get_json()["success"] is True
+
+    # a value the encoder rejects fails the request up front, not mid-stream
+    monkeypatch.setattr(timetable_app, "calculate_timetable_stats", lambda *args: {"bad": object()})
+    timetable_app._result_cache.clear()
+    response = client.post("/generate_timetable", json=tight_payload())
+    assert response.status_code == 500
+    assert "error" in response.get_json()
+
+
+def test_failed_response_is_not_cached(client, monkeypatch):
+    monkeypatch.setattr(timetable_app, "calculate_timetable_stats", lambda *args: {"bad": object()})
+    assert client.post("/generate_timetable", json=tight_payload()).status_code == 500
+    assert not timetable_app._result_cache
+
+    # the retry recomputes instead of replaying the failure
+    monkeypatch.undo()
+    response = client.post("/generate_timetable", json=tight_payload())
+    assert response.status_code == 200
+    body = response.get_data()
+    assert len(timetable_app._result_cache) == 1
+    assert client.post("/generate_timetable", json=tight_payload()).get_data() == body